@@ -1,18 +1,83 @@
 import carb.events
 import omni.kit.app
 import omni.ext
+import omni.usd
 import omni.ui as ui
 import numpy as np
 import logging
-from pxr import Usd, UsdGeom, Gf
-import netCDF4 as nc
-from pxr import Gf, Vt
-import random
+import queue
+import threading
 import time
+from typing import Final
+from pxr import Usd, UsdGeom, Gf, Sdf, Vt
+import netCDF4 as nc
+
+try:
+    from numba import njit, prange, typeof
+except ImportError:  # Numba is optional, cells are then always filled with NumPy
+    njit = None
 
 # Setup logging
 logging.basicConfig(level=logging.WARNING)
 
+# Parent of all prims authored by the extension, the single instancer holding the points of every grid cell
+# and the sphere prototype it instances at each point. Kept as parsed Sdf.Paths so USD calls don't re-parse them
+WORLD_PATH: Final = Sdf.Path("/World")
+CLOUDS_PATH: Final = WORLD_PATH.AppendChild("Clouds")
+GAS_CLOUD_PATH: Final = CLOUDS_PATH.AppendChild("GasCloud")
+POINT_PROTOTYPE_PATH: Final = GAS_CLOUD_PATH.AppendChild("Prototypes").AppendChild("Point")
+POINT_RADIUS: Final = 0.1  # Small point size
+
+# Camera used for the LOD distance, default for Omniverse Kit
+CAMERA_PATH: Final = Sdf.Path("/OmniverseKit_Persp")
+
+# NetCDF files replayed in a cycle, from 00 to NUM_FILES - 1
+NETCDF_PATH_TEMPLATE: Final = "C:/Users/pcomp/Documents/thesis-flexpart2025-main/output_concentrations_{:02d}.nc"
+NUM_FILES: Final = 12
+
+# Longest the main thread waits, in seconds, for the prefetch thread to deliver a file or release the NetCDF reader
+NETCDF_WAIT_TIMEOUT: Final = 2.0
+
+# Grid parameters
+WORLD_SIZE_X: Final = 150  # meters
+WORLD_SIZE_Z: Final = 150  # meters
+CELL_SIZE: Final = 10       # meters
+CELL_CENTER_Y: Final = 100  # Height of the cell centers used for the LOD distance
+
+# LOD (Level of Detail): full detail (100% points) closer than LOD_NEAR_DISTANCE meters to the camera,
+# medium (50%) closer than LOD_FAR_DISTANCE, low (10%) beyond
+LOD_NEAR_DISTANCE: Final = 100
+LOD_FAR_DISTANCE: Final = 300
+LOD_FACTORS: Final = (1.0, 0.5, 0.1)
+POINTS_PER_CONCENTRATION: Final = 50  # Points in a cell of concentration 1.0 at full detail
+
+# Center of every cell of the fixed size grid, as used for the LOD distance, built once instead of per rebuild
+GRID_CELL_CENTERS: Final = np.empty((WORLD_SIZE_X, WORLD_SIZE_Z, 3), dtype=np.float32)
+GRID_CELL_CENTERS[..., 0], GRID_CELL_CENTERS[..., 2] = np.indices((WORLD_SIZE_X, WORLD_SIZE_Z))
+GRID_CELL_CENTERS[..., 1] = CELL_CENTER_Y
+
+# Number of frames the generation of a rebuilt point cloud is spread over
+REBUILD_FRAMES: Final = 4
+
+# Chunks of cells with at least this many points in total are filled by the parallel Numba kernel when Numba
+# is available; below that the kernel's thread startup costs more than the single NumPy draw it replaces
+NUMBA_MIN_POINTS: Final = 100_000
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _scatter_points(positions, cell_x, cell_z, starts, num_points, half_size):
+        """
+        Fill rows starts[k]:starts[k] + num_points[k] of the (N, 3) `positions` in place with points uniformly
+        scattered over the cell at (cell_x[k], cell_z[k]) on the ground plane. Cells are spread over threads,
+        each of which draws from its own Numba random state.
+        """
+        for k in prange(len(num_points)):
+            for row in range(starts[k], starts[k] + num_points[k]):
+                positions[row, 0] = cell_x[k] + (np.random.random() * 2.0 - 1.0) * half_size
+                positions[row, 1] = 0.0
+                positions[row, 2] = cell_z[k] + (np.random.random() * 2.0 - 1.0) * half_size
+
 class CompanyPointCloudExtension(omni.ext.IExt):
     def on_startup(self, ext_id):
         print("[company.point.cloud] company point cloud startup")
@@ -25,7 +90,29 @@ class CompanyPointCloudExtension(omni.ext.IExt):
         self._last_num_points = 0
         self._update_timer = 0  # Timer for controlling update frequency
         self._update_interval = 1  # Update every 10 seconds
-        self._active_point_cells = set()  # Track (i, j) of active grid cells
+        self._rng = np.random.Generator(np.random.SFC64())  # Fast random generator for scattering points in a cell
+        self._rebuild = None  # Point cloud rebuild in progress, advanced from _on_update
+        self._scratch: dict[str, np.ndarray] = {}  # float32 work buffers reused across rebuilds, see _scratch_buffer
+        self._frame_cache: dict[int, tuple[np.ndarray, np.ndarray]] = {}  # Non-zero cells and values per file index
+
+        # Background thread reading the next NetCDF file while the current one is shown
+        self._start_prefetch()
+
+        # Compile the Numba kernel in the background rather than on the main thread in the middle of a rebuild.
+        # It is only compiled there, never launched, since Numba's threading layers may not run two launches at once
+        if njit is not None:
+            threading.Thread(target=self._warm_up_numba, name="PointCloudNumbaWarmUp", daemon=True).start()
+
+        # The stage is looked up once and only re-fetched when a stage is opened or closed
+        usd_context = omni.usd.get_context()
+        self._stage = usd_context.get_stage()
+        self._stage_event_sub = usd_context.get_stage_event_stream().create_subscription_to_pop(
+            self._on_stage_event, name="PointCloudStageEvent"
+        )
+
+        # Anonymous layer holding every prim the extension authors. Rebuilds only set new attribute values on its
+        # specs, clearing it at once removes them all on failure and shutdown
+        self._clouds_layer = Sdf.Layer.CreateAnonymous("clouds")
 
         with self._window.frame:
             with ui.VStack():
@@ -43,6 +130,33 @@ class CompanyPointCloudExtension(omni.ext.IExt):
         # Unsubscribe from the update event stream
         if self._update_sub:
             self._update_sub.unsubscribe()
+        if self._stage_event_sub:
+            self._stage_event_sub.unsubscribe()
+
+        # Release the scratch buffers
+        self._scratch.clear()
+
+        self._stop_prefetch()
+
+        # Detach the clouds layer from the stage it was inserted into
+        if self._stage:
+            session_layer = self._stage.GetSessionLayer()
+            if self._clouds_layer.identifier in session_layer.subLayerPaths:
+                session_layer.subLayerPaths.remove(self._clouds_layer.identifier)
+        self.remove_all_point_clouds()
+
+    def _on_stage_event(self, e: carb.events.IEvent):
+        """
+        Keeps the cached stage in sync with the USD context.
+        """
+        if e.type == int(omni.usd.StageEventType.OPENED):
+            self._stage = omni.usd.get_context().get_stage()
+        elif e.type == int(omni.usd.StageEventType.CLOSING):
+            # Stop a rebuild that would otherwise keep authoring into the closing stage
+            if self._rebuild is not None:
+                self._rebuild.close()
+                self._rebuild = None
+            self._stage = None
 
     def _on_update(self, e: carb.events.IEvent):
         """
@@ -51,165 +165,351 @@ class CompanyPointCloudExtension(omni.ext.IExt):
         dt = e.payload["dt"]  # Time elapsed since the last frame (in seconds)
         self._update_timer += dt  # Accumulate elapsed time
 
+        # Advance a rebuild in progress by one step per frame
+        if self._rebuild is not None:
+            if next(self._rebuild, StopIteration) is StopIteration:
+                self._rebuild = None
+            return
+
         # Update every `_update_interval` seconds
         if self._update_timer >= self._update_interval:
             self._update_timer = 0  # Reset the timer
-            self.load_netcdf_point_cloud()  # Load new data
+            self._rebuild = self._rebuild_point_cloud()  # Load new data over the coming frames
+            next(self._rebuild, None)
 
-    def add_point_cloud_in_grid(self, x, z, gas_concentration):
+    def add_point_clouds_in_grid(self, positions, cell_x, cell_z, num_points):
         """
-        Create a grid system centered at (0, 0, 0) with an area of 1500 x 1500 meters.
-        Add multiple points to a cell based on a gas concentration value.
-        Uses LOD (Level of Detail) based on camera distance.
+        Scatter the points of grid cells over the WORLD_SIZE_X x WORLD_SIZE_Z meter grid indexed from (0, 0).
+        Fill `positions` in place with `num_points[k]` points scattered over the cell at (cell_x[k], cell_z[k]),
+        for every cell k in order; `positions` must hold num_points.sum() rows.
         """
+        half_size = CELL_SIZE / 2
 
+        # Many points are filled in parallel straight into the output buffer, without NumPy temporaries
+        if njit is not None and len(positions) >= NUMBA_MIN_POINTS:
+            starts = np.cumsum(num_points) - num_points
+            _scatter_points(positions, cell_x, cell_z, starts, num_points, half_size)
+            return
 
+        # Otherwise scatter the points uniformly over their cell on the ground plane in one draw.
+        # Offsets are drawn as float32 in [0, 1) and moved in place to [-half_size, half_size) around the centers
+        xz = self._scratch_buffer("offsets", len(positions), 2)
+        self._rng.random(dtype=np.float32, out=xz)
+        xz *= CELL_SIZE
+        xz -= half_size
+        xz[:, 0] += np.repeat(cell_x, num_points)
+        xz[:, 1] += np.repeat(cell_z, num_points)
 
-        # Grid parameters
-        world_size_x = 150  # meters
-        world_size_z = 150  # meters
-        cell_size = 10       # meters
-        half_world_x = world_size_x / 2
-        half_world_z = world_size_z / 2
-
-        # Convert world coordinates (x, z) to grid cell (i, j)
-        i = int((x + half_world_x) / cell_size) - int(world_size_x / (2 * cell_size))
-        j = int((z + half_world_z) / cell_size) - int(world_size_z / (2 * cell_size))
-
-        # Validate cell coordinates
-        if i is None or j is None:
-            raise ValueError("World coordinates (x, z) must be provided.")
-
-        # Get the current USD stage
-        stage = omni.usd.get_context().get_stage()
-        if not stage:
-            raise RuntimeError("Failed to get the current USD stage.")
-
-        # Get camera transform
-        camera_path = "/OmniverseKit_Persp"  # Default for Omniverse Kit
-        camera = UsdGeom.Camera.Get(stage, camera_path)
-        if not camera:
-            raise RuntimeError("Camera not found in USD stage.")
-
-        time = Usd.TimeCode.Default()
-        cam_transform = camera.ComputeLocalToWorldTransform(time)
-        cam_position = Gf.Vec3f(cam_transform.ExtractTranslation())  # Convert to Vec3f
-
-        # Compute distance from camera to the grid cell
-        cell_center = Gf.Vec3f(x, 100, z)
-        distance = (cam_position - cell_center).GetLength()
-
-        # Determine LOD factor based on distance for performance optimization
-        if distance < 100:
-            lod_factor = 1.0  # Full detail (100% points)
-        elif distance < 300:
-            lod_factor = 0.5  # Medium detail (50% points)
-        else:
-            lod_factor = 0.1  # Low detail (10% points)
+        positions[:, 0] = xz[:, 0]
+        positions[:, 1] = 0.0
+        positions[:, 2] = xz[:, 1]
 
-        # Calculate number of points based on gas concentration and LOD factor
-        num_points = int(gas_concentration * 50 * lod_factor)
-        num_points = max(1, num_points)  # At least one point
+    def _warm_up_numba(self):
+        """
+        Compile, without running, _scatter_points for the argument types add_point_clouds_in_grid passes.
+        Runs on its own thread.
+        """
+        nonzero = np.argwhere(np.ones((2, 2)))  # Index columns with the same dtype and layout as read_netcdf_frame's
+        num_points = np.ones(len(nonzero), dtype=np.int32)
+        arguments = (np.empty((len(nonzero), 3), dtype=np.float32), nonzero[:, 0], nonzero[:, 1],
+                     np.cumsum(num_points) - num_points, num_points, CELL_SIZE / 2)
+        try:
+            _scatter_points.compile(tuple(typeof(argument) for argument in arguments))
+        except Exception as e:
+            logging.warning(f"Failed to compile the Numba point kernel: {e}")
 
-        #logging.warning(f"Adding {num_points} points to cell ({i}, {j}) where LOD is {lod_factor}")
+    def _rebuild_chunks(self, num_points, num_chunks=REBUILD_FRAMES):
+        """
+        Split the cells into at most `num_chunks` consecutive chunks of the same size, the last one possibly smaller,
+        yielding each chunk's slice of the cells and of the rows their `num_points` fill in the positions buffer.
+        """
+        ends = np.cumsum(num_points)
+        chunk_size = max(1, -(-len(num_points) // num_chunks))
+        for first in range(0, len(num_points), chunk_size):
+            chunk = slice(first, first + chunk_size)
+            yield chunk, slice(int(ends[first] - num_points[first]), int(ends[chunk][-1]))
 
-        # Define the bounds of the cell
-        cell_min_x = x - (cell_size / 2)
-        cell_max_x = x + (cell_size / 2)
-        cell_min_z = z - (cell_size / 2)
-        cell_max_z = z + (cell_size / 2)
+    def _scratch_buffer(self, name, rows, columns):
+        """
+        Return the first `rows` rows of the float32 scratch buffer `name`, only reallocating it when it is too small.
+        USD copies attribute values when they are set, so the buffers can be refilled by the next rebuild.
+        """
+        buffer = self._scratch.get(name)
+        if buffer is None or len(buffer) < rows:
+            buffer = np.empty((rows, columns), dtype=np.float32)
+            self._scratch[name] = buffer
+        return buffer[:rows]
+
+    def _attach_clouds_layer(self, stage):
+        """ Insert the clouds layer as the strongest sublayer of the stage's session layer, once. """
+        session_layer = stage.GetSessionLayer()
+        if self._clouds_layer.identifier not in session_layer.subLayerPaths:
+            session_layer.subLayerPaths.insert(0, self._clouds_layer.identifier)
+
+            # The clouds layer only holds an `over` for /World, so define it in the session layer when the
+            # stage doesn't. The session layer is never cleared, so /World isn't resynced with every rebuild
+            world = stage.GetPrimAtPath(WORLD_PATH)
+            if not world or not world.IsDefined():
+                self._define_prim_spec(session_layer, WORLD_PATH, "Xform")
+
+        return self._clouds_layer
+
+    def _define_prim_spec(self, layer, path, type_name):
+        """ Create (or reuse) a defining prim spec of type `type_name` at `path` in `layer`. """
+        prim_spec = Sdf.CreatePrimInLayer(layer, path)
+        if not prim_spec:
+            raise RuntimeError(f"Failed to create prim at path: {path}")
+
+        # Reused specs are left untouched, so they don't send change notices
+        if prim_spec.specifier != Sdf.SpecifierDef:
+            prim_spec.specifier = Sdf.SpecifierDef
+        if prim_spec.typeName != type_name:
+            prim_spec.typeName = type_name
+        return prim_spec
+
+    def _author_instancer_spec(self, layer, path, prototype_path, positions, colors):
+        """
+        Author a PointInstancer prim spec placing a small sphere at each of `positions` into `layer`.
+        The prims are defined by the first call, later calls only set new attribute values.
+        """
+        self._define_prim_spec(layer, prototype_path.GetParentPath(), "Scope")
+        prototype_spec = self._define_prim_spec(layer, prototype_path, "Sphere")
+        self._set_attribute_spec(prototype_spec, UsdGeom.Tokens.radius, Sdf.ValueTypeNames.Double, POINT_RADIUS)
+
+        prim_spec = self._define_prim_spec(layer, path, "PointInstancer")
+        prototypes = layer.GetRelationshipAtPath(prim_spec.path.AppendProperty(UsdGeom.Tokens.prototypes))
+        if not prototypes:
+            prototypes = Sdf.RelationshipSpec(prim_spec, UsdGeom.Tokens.prototypes)
+            prototypes.targetPathList.explicitItems = [prototype_path]
+
+        # FromNumpy hands a C-contiguous float32 (N, 3) buffer to USD in a single copy
+        positions = np.ascontiguousarray(positions, dtype=np.float32)
+        colors = np.ascontiguousarray(colors, dtype=np.float32)
+
+        # Every instance uses the one prototype and gets its own color
+        self._set_attribute_spec(prim_spec, UsdGeom.Tokens.positions, Sdf.ValueTypeNames.Point3fArray,
+                                 Vt.Vec3fArray.FromNumpy(positions))
+        self._set_attribute_spec(prim_spec, UsdGeom.Tokens.protoIndices, Sdf.ValueTypeNames.IntArray,
+                                 Vt.IntArray.FromNumpy(np.zeros(len(positions), dtype=np.int32)))
+        self._set_attribute_spec(prim_spec, UsdGeom.Tokens.primvarsDisplayColor, Sdf.ValueTypeNames.Color3fArray,
+                                 Vt.Vec3fArray.FromNumpy(colors), UsdGeom.Tokens.varying)
+
+    def _set_attribute_spec(self, prim_spec, name, type_name, value, interpolation=None):
+        """ Create (or reuse) the attribute spec `name` on `prim_spec` and set its default value. """
+        attr_spec = prim_spec.layer.GetAttributeAtPath(prim_spec.path.AppendProperty(name))
+        if not attr_spec:
+            attr_spec = Sdf.AttributeSpec(prim_spec, name, type_name)
+            if interpolation is not None:
+                attr_spec.SetInfo(UsdGeom.Tokens.interpolation, interpolation)
+
+        attr_spec.default = value
 
-        # Add points to the cell
-        for point_index in range(num_points):
-            point_x = random.uniform(cell_min_x, cell_max_x)
-            point_z = random.uniform(cell_min_z, cell_max_z)
+    def concentration_to_color(self, conc, max_conc=1.0):
+        """ Maps concentration (0 to max_conc) to RGB color. """
+        return Gf.Vec3f(*self.concentrations_to_colors(np.array([conc]), max_conc)[0].tolist())
+
+    def concentrations_to_colors(self, concentrations, max_conc=1.0):
+        """ Maps an array of concentrations (0 to max_conc) to an (N, 3) array of RGB colors. """
+        norm = np.minimum(np.asarray(concentrations, dtype=np.float32) / max_conc, 1.0)
+
+        # Blue → Green below half the max concentration, Green → Red above it. With shifted = 2 * norm - 1
+        # that is red = max(shifted, 0), green = 1 - |shifted| and blue = max(-shifted, 0), written channel by channel
+        colors = np.empty((len(norm), 3), dtype=np.float32)
+        shifted = colors[:, 1]
+        np.multiply(norm, 2.0, out=shifted)
+        shifted -= 1.0
+        np.maximum(shifted, 0.0, out=colors[:, 0])
+        np.negative(shifted, out=colors[:, 2])
+        np.maximum(colors[:, 2], 0.0, out=colors[:, 2])
+        np.abs(shifted, out=shifted)
+        np.subtract(1.0, shifted, out=shifted)
+        return colors
 
-            point_path = f"/World/Point_{i}_{j}_{point_index}"
-            point = UsdGeom.Sphere.Define(stage, point_path)
-            if not point:
-                raise RuntimeError(f"Failed to create point at path: {point_path}")
+    def remove_all_point_clouds(self):
+        # Every cloud prim lives in the clouds layer, so a single clear removes them all
+        self._clouds_layer.Clear()
 
-            point.CreateRadiusAttr(0.1)  # Small point size
 
-            # Set position using an existing translate operation
-            xformable = UsdGeom.Xformable(point)
-            translate_op = None
-            for op in xformable.GetOrderedXformOps():
-                if op.GetOpType() == UsdGeom.XformOp.TypeTranslate:
-                    translate_op = op
-                    break
-            if translate_op is None:
-                translate_op = xformable.AddTranslateOp()
+    def read_netcdf_frame(self, file_index):
+        """ Read a NetCDF file and return the (x, z) indices and values of its non-zero concentrations. """
+        file_path = NETCDF_PATH_TEMPLATE.format(file_index)
 
-            translate_op.Set(Gf.Vec3f(point_x, 0, point_z))
+        # A reader stuck on another thread fails this file instead of freezing the caller
+        if not self._netcdf_lock.acquire(timeout=NETCDF_WAIT_TIMEOUT):
+            raise TimeoutError(f"NetCDF reader busy, skipped .nc file {file_index:02d}")
 
-            # Set point color (white for now)
-            color = self.concentration_to_color(gas_concentration)
-            point.CreateDisplayColorAttr(Vt.Vec3fArray([color]))
-            self._active_point_cells.add((i, j))
+        try:
+            # Open the NetCDF file
+            dataset = nc.Dataset(file_path, mode="r")
 
-        return i, j
+            # Read the 'concentrations' of the whole grid in one contiguous slice, with missing (masked)
+            # samples as zero concentration, so all later indexing hits a plain float32 ndarray.
+            # netCDF4 only builds a masked array when some samples are actually missing
+            variable = dataset.variables["concentrations"]
+            variable.set_always_mask(False)
+            concentrations = variable[:WORLD_SIZE_X, :WORLD_SIZE_Z]
+            if np.ma.isMaskedArray(concentrations):
+                concentrations = concentrations.filled(0.0)
+            gas_concentration = np.ascontiguousarray(concentrations, dtype=np.float32)
 
+            # Close the dataset
+            dataset.close()
+        finally:
+            self._netcdf_lock.release()
 
-    def concentration_to_color(self, conc, max_conc=1.0):
-        """ Maps concentration (0 to max_conc) to RGB color. """
-        norm = min(conc / max_conc, 1.0)
-
-        if norm < 0.5:
-            # Blue → Green
-            t = norm / 0.5
-            return Gf.Vec3f(0.0, t, 1.0 - t)
-        else:
-            # Green → Red
-            t = (norm - 0.5) / 0.5
-            return Gf.Vec3f(t, 1.0 - t, 0.0)
-    
-    def remove_all_point_clouds(self):
-        stage = omni.usd.get_context().get_stage()
-        if not stage:
-            return
+        # Find every non-zero lat/lon cell of the 150 x 150 grid and gather its concentration
+        nonzero = np.argwhere(gas_concentration != 0)
+        values = gas_concentration[nonzero[:, 0], nonzero[:, 1]]
+        return nonzero, values
 
-        for (i, j) in self._active_point_cells:
-            for point_index in range(200):
-                point_path = f"/World/Point_{i}_{j}_{point_index}"
-                prim = stage.GetPrimAtPath(point_path)
-                if prim and prim.IsValid():
-                    stage.RemovePrim(point_path)
+    def _start_prefetch(self):
+        """
+        Start the background thread reading the next NetCDF file while the current one is shown.
+        It never touches USD, and netCDF access is serialized since the library isn't thread safe.
+        """
+        self._netcdf_lock = threading.Lock()
+        self._prefetch_requests = queue.Queue()
+        self._prefetch_ready = queue.Queue()
+        self._prefetch_pending = set()  # File indices requested but not collected yet
+        self._prefetch_thread = threading.Thread(target=self._prefetch_worker, name="PointCloudPrefetch", daemon=True)
+        self._prefetch_thread.start()
+
+    def _stop_prefetch(self):
+        self._prefetch_requests.put(None)
+        self._prefetch_thread.join(timeout=1.0)
+
+    def _prefetch_worker(self):
+        """ Read requested files into frames until a None request arrives. Runs on the prefetch thread. """
+        while True:
+            file_index = self._prefetch_requests.get()
+            if file_index is None:
+                return
+
+            try:
+                frame = self.read_netcdf_frame(file_index)
+            except Exception as e:
+                # The main thread reads the file itself when it is needed
+                logging.warning(f"Failed to prefetch .nc file {file_index:02d}: {e}")
+                frame = None
+
+            self._prefetch_ready.put((file_index, frame))
+
+    def _request_prefetch(self, file_index):
+        if file_index not in self._frame_cache and file_index not in self._prefetch_pending:
+            self._prefetch_pending.add(file_index)
+            self._prefetch_requests.put(file_index)
+
+    def _collect_prefetched(self, wait_for=None, timeout=NETCDF_WAIT_TIMEOUT):
+        """
+        Move finished prefetches into the frame cache, waiting up to `timeout` seconds for `wait_for` if it is
+        still being read. A file that isn't delivered in time stays pending and the caller reads it itself.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if wait_for in self._prefetch_pending:
+                    file_index, frame = self._prefetch_ready.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    file_index, frame = self._prefetch_ready.get(block=False)
+            except queue.Empty:
+                if wait_for in self._prefetch_pending:
+                    logging.warning(f"Prefetch of .nc file {wait_for:02d} timed out, reading it directly")
+                return
+
+            self._prefetch_pending.discard(file_index)
+            if frame is not None:
+                self._frame_cache[file_index] = frame
+
+    def _lod_point_counts(self, nonzero, values, cam_position):
+        """ Return the number of points of every non-zero cell from its concentration and distance to the camera. """
+        # Compute the distance from the camera to every cell by broadcasting against the camera position
+        cell_centers = GRID_CELL_CENTERS[nonzero[:, 0], nonzero[:, 1]]
+        cell_centers -= cam_position
+        distances = np.sqrt(np.einsum("ij,ij->i", cell_centers, cell_centers))
 
-        #logging.warning(f"Removed {len(self._active_point_cells)} cells' points")
-        self._active_point_cells.clear()
+        # Determine LOD factor based on distance for performance optimization
+        near_factor, far_factor, low_factor = LOD_FACTORS
+        lod_factors = np.select(
+            [distances < LOD_NEAR_DISTANCE, distances < LOD_FAR_DISTANCE], [near_factor, far_factor],
+            default=low_factor,
+        )
 
+        # Calculate number of points based on gas concentration and LOD factor, at least one point
+        return np.maximum(1, (values * POINTS_PER_CONCENTRATION * lod_factors).astype(np.int32))
 
     def load_netcdf_point_cloud(self):
         """ Load data from NetCDF file using netCDF4 and process all lat/lon dimensions. """
-        file_path = f"C:/Users/pcomp/Documents/thesis-flexpart2025-main/output_concentrations_{self._current_file_index:02d}.nc"
-        #logging.warning(file_path)
-        self.remove_all_point_clouds()  # 🧹 Clear previous points
+        # Loading on demand replaces any rebuild that is still spread over the coming frames
+        if self._rebuild is not None:
+            self._rebuild.close()
+            self._rebuild = None
 
+        for _ in self._rebuild_point_cloud():
+            pass
 
+    def _rebuild_point_cloud(self):
+        """
+        Rebuild the point cloud from the current NetCDF file as a generator, one step per frame:
+        the file and LOD are resolved first, the cells' points are generated over REBUILD_FRAMES
+        steps and the finished cloud is authored at once, so the previous cloud stays visible until then.
+        """
         try:
-            # Open the NetCDF file
-            dataset = nc.Dataset(file_path, mode="r")
-
-            # Extract the 'concentrations' variable
-            concentrations = dataset.variables["concentrations"]
-            gas_concentration = concentrations[:]
-
-            # Close the dataset
-            dataset.close()
-
-            # Iterate over all lat/lon dimensions in 150 x 150 values
-            for x in range(150):
-                for z in range(150):
-                    conc = gas_concentration[x, z]
-                    if conc == 0:
-                        continue
+            stage = self._stage
+            if not stage:
+                raise RuntimeError("Failed to get the current USD stage.")
+
+            # Get the camera transform once, it is shared by the LOD of every cell
+            camera = UsdGeom.Camera.Get(stage, CAMERA_PATH)
+            if not camera:
+                raise RuntimeError("Camera not found in USD stage.")
+
+            cam_transform = camera.ComputeLocalToWorldTransform(Usd.TimeCode.Default())
+            cam_position = np.array(cam_transform.ExtractTranslation(), dtype=np.float32)
+
+            # The files are replayed in a cycle, so each one only has to be parsed once
+            self._collect_prefetched(wait_for=self._current_file_index)
+            frame = self._frame_cache.get(self._current_file_index)
+            if frame is None:
+                frame = self.read_netcdf_frame(self._current_file_index)
+                self._frame_cache[self._current_file_index] = frame
+            nonzero, values = frame
+
+            # Start reading the next file while this one is being built
+            self._request_prefetch((self._current_file_index + 1) % NUM_FILES)
+
+            # Points of every cell from its concentration and LOD, at least one point
+            num_points = self._lod_point_counts(nonzero, values, cam_position)
+            yield
+
+            # Generate the cells' points in REBUILD_FRAMES chunks, each filling its own rows of the one positions buffer
+            cell_x, cell_z = nonzero[:, 0], nonzero[:, 1]
+            positions = self._scratch_buffer("positions", int(num_points.sum()), 3)
+            for chunk, rows in self._rebuild_chunks(num_points):
+                self.add_point_clouds_in_grid(positions[rows], cell_x[chunk], cell_z[chunk], num_points[chunk])
+                yield
+
+            layer = self._attach_clouds_layer(stage)
+
+            # Every point of a cell shares the color of its cell, gathered into the reused scratch buffer.
+            # Indices are in range, so "clip" only skips take's buffering
+            point_cells = np.repeat(np.arange(len(values)), num_points)
+            colors = self._scratch_buffer("colors", len(positions), 3)
+            np.take(self.concentrations_to_colors(values), point_cells, axis=0, out=colors, mode="clip")
+
+            # Replace the previous cloud's values in one change notification. The prims stay in place, so Hydra
+            # only updates the instancer's attributes, an empty file just leaves it without instances
+            with Sdf.ChangeBlock():
+                self._define_prim_spec(layer, CLOUDS_PATH, "Xform")
+                self._author_instancer_spec(layer, GAS_CLOUD_PATH, POINT_PROTOTYPE_PATH, positions, colors)
+
+            # Rebuilds run every second, so the summary stays below the configured WARNING level
+            logging.info(
+                f"Loaded .nc file {self._current_file_index:02d}: {len(num_points)} cells, {len(positions)} points"
+            )
 
-                    # Call grid_manager for this lat/lon pair and concentration
-                    self.add_point_cloud_in_grid(x, z, conc)
-            
             # Increment the file index for the next iteration
-            self._current_file_index = (self._current_file_index + 1) % 12  # Cycle from 00 to 11
+            self._current_file_index = (self._current_file_index + 1) % NUM_FILES  # Cycle from 00 to 11
 
         except Exception as e:
+            self.remove_all_point_clouds()
             logging.error(f"Failed to load .nc file: {e}")
@@ -1 +1,2 @@
-from .test_hello_world import *
\ No newline at end of file
+from .test_hello_world import *
+from .test_point_cloud import *
@@ -0,0 +1,166 @@
+import omni.kit.test
+import omni.usd
+import numpy as np
+import threading
+import types
+
+# Import extension python module we are testing with absolute import path, as if we are external user (other extension)
+import company.point.cloud
+
+
+class TestPointCloud(omni.kit.test.AsyncTestCase):
+    async def setUp(self):
+        # The helpers under test don't need the extension to be started
+        self._ext = company.point.cloud.CompanyPointCloudExtension()
+
+    async def test_concentrations_to_colors(self):
+        colors = self._ext.concentrations_to_colors(np.array([0.0, 0.25, 0.5, 1.0, 2.0]))
+
+        self.assertEqual(colors.shape, (5, 3))
+        self.assertEqual(colors.dtype, np.float32)
+        np.testing.assert_allclose(colors[0], [0.0, 0.0, 1.0])  # Blue
+        np.testing.assert_allclose(colors[1], [0.0, 0.5, 0.5])
+        np.testing.assert_allclose(colors[2], [0.0, 1.0, 0.0])  # Green
+        np.testing.assert_allclose(colors[3], [1.0, 0.0, 0.0])  # Red
+        np.testing.assert_allclose(colors[4], [1.0, 0.0, 0.0])  # Clamped to max_conc
+
+    async def test_concentration_to_color_matches_vectorized(self):
+        for conc in (0.0, 0.3, 0.7, 1.0):
+            expected = self._ext.concentrations_to_colors(np.array([conc]))[0]
+            np.testing.assert_allclose(list(self._ext.concentration_to_color(conc)), expected)
+
+    async def test_add_point_clouds_in_grid(self):
+        # Only the scattering state set up by on_startup is needed
+        self._ext._rng = np.random.Generator(np.random.SFC64(0))
+        self._ext._scratch = {}
+
+        cells = np.array([[0, 0], [3, 7], [149, 149], [10, 20], [75, 0]], dtype=np.intp)  # As from np.argwhere
+        num_points = np.array([3, 1, 6, 2, 4], dtype=np.int32)
+        positions = np.full((int(num_points.sum()), 3), np.nan, dtype=np.float32)
+
+        # Five cells in three chunks: two of two cells and an uneven last one of a single cell
+        chunks = list(self._ext._rebuild_chunks(num_points, num_chunks=3))
+        self.assertEqual([len(num_points[chunk]) for chunk, _ in chunks], [2, 2, 1])
+        for chunk, rows in chunks:
+            self._ext.add_point_clouds_in_grid(positions[rows], cells[chunk, 0], cells[chunk, 1], num_points[chunk])
+
+        # An empty chunk fills nothing
+        self._ext.add_point_clouds_in_grid(positions[:0], cells[:0, 0], cells[:0, 1], num_points[:0])
+
+        # Every row lands on the ground plane within its own cell
+        point_cells = np.repeat(cells, num_points, axis=0)
+        half_size = company.point.cloud.CELL_SIZE / 2
+        self.assertFalse(np.isnan(positions).any())
+        np.testing.assert_array_equal(positions[:, 1], 0.0)
+        self.assertTrue((np.abs(positions[:, 0] - point_cells[:, 0]) <= half_size).all())
+        self.assertTrue((np.abs(positions[:, 2] - point_cells[:, 1]) <= half_size).all())
+
+    async def test_lod_point_counts(self):
+        nonzero = np.array([[10, 10], [10, 110], [10, 12]], dtype=np.intp)
+        values = np.array([1.0, 1.0, 0.001], dtype=np.float32)
+
+        # Camera right above the first cell: near, far (exactly LOD_NEAR_DISTANCE away) and near, at least one point
+        counts = self._ext._lod_point_counts(nonzero, values, np.array([10.0, 100.0, 10.0], dtype=np.float32))
+        self.assertEqual(counts.dtype, np.int32)
+        np.testing.assert_array_equal(counts, [50, 25, 1])
+
+        # Camera LOD_FAR_DISTANCE or more away from every cell: low
+        counts = self._ext._lod_point_counts(nonzero, values, np.array([10.0, 100.0, -300.0], dtype=np.float32))
+        np.testing.assert_array_equal(counts, [5, 5, 1])
+
+    async def test_prefetch(self):
+        reads = []
+
+        def read_netcdf_frame(file_index):
+            reads.append(file_index)
+            if file_index == 5:
+                raise OSError("unreadable")
+            return np.zeros((0, 2), dtype=np.intp), np.zeros(0, dtype=np.float32)
+
+        self._ext.read_netcdf_frame = read_netcdf_frame
+        self._ext._frame_cache = {}
+        self._ext._start_prefetch()
+        try:
+            # A file is only requested once while it is pending and is cached once collected
+            self._ext._request_prefetch(3)
+            self._ext._request_prefetch(3)
+            self._ext._collect_prefetched(wait_for=3)
+            self.assertEqual(reads, [3])
+            self.assertEqual(set(self._ext._frame_cache), {3})
+            self.assertFalse(self._ext._prefetch_pending)
+
+            # A cached file isn't read again
+            self._ext._request_prefetch(3)
+            self._ext._collect_prefetched(wait_for=3)
+            self.assertEqual(reads, [3])
+
+            # A failed read isn't cached, so the rebuild reads the file itself
+            self._ext._request_prefetch(5)
+            self._ext._collect_prefetched(wait_for=5)
+            self.assertEqual(set(self._ext._frame_cache), {3})
+            self.assertFalse(self._ext._prefetch_pending)
+        finally:
+            self._ext._stop_prefetch()
+
+    async def test_prefetch_wait_times_out(self):
+        release = threading.Event()
+
+        def read_netcdf_frame(file_index):
+            release.wait()
+            return np.zeros((0, 2), dtype=np.intp), np.zeros(0, dtype=np.float32)
+
+        self._ext.read_netcdf_frame = read_netcdf_frame
+        self._ext._frame_cache = {}
+        self._ext._start_prefetch()
+        try:
+            # A stuck read gives up waiting and leaves the file pending
+            self._ext._request_prefetch(7)
+            self._ext._collect_prefetched(wait_for=7, timeout=0.05)
+            self.assertNotIn(7, self._ext._frame_cache)
+            self.assertIn(7, self._ext._prefetch_pending)
+
+            # and the file is cached once it arrives after all
+            release.set()
+            self._ext._collect_prefetched(wait_for=7)
+            self.assertIn(7, self._ext._frame_cache)
+        finally:
+            release.set()
+            self._ext._stop_prefetch()
+
+    async def test_rebuild_advances_one_step_per_update(self):
+        steps = []
+
+        def rebuild():
+            for step in range(3):
+                steps.append(step)
+                yield
+
+        self._ext._update_timer = 0
+        self._ext._update_interval = 1
+        self._ext._rebuild = rebuild()
+        event = types.SimpleNamespace(payload={"dt": 0.0})
+        for expected in ([0], [0, 1], [0, 1, 2]):
+            self._ext._on_update(event)
+            self.assertEqual(steps, expected)
+
+        # The update after the last step finishes the rebuild
+        self._ext._on_update(event)
+        self.assertIsNone(self._ext._rebuild)
+
+    async def test_closing_stage_cancels_rebuild(self):
+        closed = []
+
+        def rebuild():
+            try:
+                yield
+                yield
+            finally:
+                closed.append(True)
+
+        self._ext._rebuild = rebuild()
+        next(self._ext._rebuild)
+        self._ext._on_stage_event(types.SimpleNamespace(type=int(omni.usd.StageEventType.CLOSING)))
+
+        self.assertEqual(closed, [True])
+        self.assertIsNone(self._ext._rebuild)
+        self.assertIsNone(self._ext._stage)